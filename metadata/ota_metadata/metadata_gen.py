@@ -17,19 +17,81 @@
 
 import os
 import re
-import glob
+import json
+import mmap
 import argparse
+import queue
+import threading
 import zstandard
 import igittigitt
+import wcmatch.glob
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 from hashlib import sha256
 from pathlib import Path
-from packaging import version
-from functools import cmp_to_key
+from functools import partial
 
 ZSTD_COMPRESSION_EXTENSION = "zst"
 ZSTD_COMPRESSION_LEVEL = 10
 ZSTD_MULTITHREADS = 2
+# NOTE: 0 uses the default window of the compression level. A larger window
+#       (i.e., 27, the default upper limit of zstd decompressors) may compress
+#       large files better, but the decompressor then needs up to
+#       2**window_log bytes of memory per frame, and each compressor several
+#       times as much (~800MiB for window_log 27 with 2 zstd threads).
+#       Files smaller than the window only need a window as large as the file.
+ZSTD_WINDOW_LOG = 0
+ZSTD_PROBE_SIZE = 64 * 1024  # 64KiB
+ZSTD_PROBE_RATIO_MARGIN = 0.9
 CHUNK_SIZE = 4 * (1024**2)  # 4MiB
+OUTPUT_BUFFER_SIZE = 1024**2  # 1MiB
+
+
+def _available_cpus():
+    # NOTE: respect the CPU affinity (i.e., taskset or cgroup cpusets), which
+    #       os.cpu_count ignores, where it is available
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+DEFAULT_WORKERS = _available_cpus()
+# NOTE: only hashing benefits from using every CPU, each compressor holds its
+#       own zstd threads and window, so fewer files are compressed at once
+DEFAULT_COMPRESS_WORKERS = min(4, DEFAULT_WORKERS)
+
+_thread_local = threading.local()
+
+
+def _read_buffer() -> memoryview:
+    """Return the CHUNK_SIZE read buffer of the calling thread.
+
+    The buffer is allocated once and reused with readinto(), instead of
+    allocating a new bytes object for every chunk read.
+    """
+    if (buf := getattr(_thread_local, "read_buffer", None)) is None:
+        buf = _thread_local.read_buffer = memoryview(bytearray(CHUNK_SIZE))
+    return buf
+
+
+@contextmanager
+def _open_sequential(path, *, drop_cache=True):
+    """Open <path> unbuffered for reading it once from the beginning to the end.
+
+    The kernel is advised to read ahead aggressively, and with <drop_cache>, to
+    drop the file from the page cache afterward, so that walking through a huge
+    rootfs doesn't evict more useful pages.
+    """
+    with open(path, "rb", buffering=0) as f:
+        # NOTE: posix_fadvise is not available on every platform
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        try:
+            yield f
+        finally:
+            if drop_cache and hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
 
 
 def zstd_compress_file(
@@ -42,34 +104,74 @@ def zstd_compress_file(
 ) -> bool:
     if (src_size := os.path.getsize(src_fpath)) < filesize_threshold:
         return False  # skip file with too small size
-    # NOTE: interrupt the whole process if compression failed
-    with open(src_fpath, "rb") as src_f, open(dst_fpath, "wb") as dst_f:
-        with cctx.stream_writer(dst_f, size=src_size) as compressor:
-            while data := src_f.read(CHUNK_SIZE):
-                compressor.write(data)
-    # drop compressed file if cmpr ratio is too small or compressed failed
-    if (
-        not (compressed_bytes := os.path.getsize(dst_fpath))
-        or src_size / compressed_bytes < cmpr_ratio
-    ):
-        try:
-            os.remove(dst_fpath)
-        except OSError:
-            pass
-        return False
-    # everything is fine, return True here
-    return True
+    buf = _read_buffer()
+    # NOTE: compress into a temporary file and rename it at the end, so that
+    #       <dst_fpath> is never seen half-written by another thread or by the
+    #       "already compressed" check of the next run.
+    tmp_fpath = f"{dst_fpath}.{os.getpid()}-{threading.get_ident()}.tmp"
+    # NOTE: interrupt the whole process if compression failed, but never leave
+    #       the temporary file behind in <compressed_dir>
+    try:
+        with _open_sequential(src_fpath) as src_f:
+            # compress the head of the file in memory first, to skip
+            # incompressible files without writing anything to the disk
+            probe_size = src_f.readinto(buf[:ZSTD_PROBE_SIZE])
+            probe = cctx.compress(buf[:probe_size])
+            if probe_size >= src_size:
+                # the whole file fits in the probe, so the probe is the result
+                if src_size / len(probe) < cmpr_ratio:
+                    return False
+                with open(tmp_fpath, "wb") as dst_f:
+                    dst_f.write(probe)
+                os.replace(tmp_fpath, dst_fpath)
+                return True
+            # NOTE: the head of a file is not always representative for the
+            #       whole file, so leave some margin before giving up on it
+            if probe_size / len(probe) < cmpr_ratio * ZSTD_PROBE_RATIO_MARGIN:
+                return False
+
+            src_f.seek(0)
+            with open(tmp_fpath, "wb") as dst_f:
+                with cctx.stream_writer(dst_f, size=src_size) as compressor:
+                    while n := src_f.readinto(buf):
+                        compressor.write(buf[:n])
+        # drop compressed file if cmpr ratio is too small or compressed failed
+        if (
+            not (compressed_bytes := os.path.getsize(tmp_fpath))
+            or src_size / compressed_bytes < cmpr_ratio
+        ):
+            _remove_silently(tmp_fpath)
+            return False
+        # everything is fine, return True here
+        os.replace(tmp_fpath, dst_fpath)
+        return True
+    except BaseException:
+        _remove_silently(tmp_fpath)
+        raise
+
+
+def _remove_silently(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
 
 
-def _file_sha256(filename):
-    ONE_MB = 1048576
-    with open(filename, "rb") as f:
+def _file_sha256(filename, *, drop_cache=True):
+    buf = _read_buffer()
+    with _open_sequential(filename, drop_cache=drop_cache) as f:
         m = sha256()
-        while True:
-            d = f.read(ONE_MB)
-            if d == b"":
-                break
-            m.update(d)
+        n = f.readinto(buf)
+        m.update(buf[:n])
+        # NOTE: the rest of a file larger than the read buffer is hashed
+        #       directly from the page cache through mmap, saving the copy
+        #       into the read buffer.
+        if n == len(buf) and (size := os.fstat(f.fileno()).st_size) > n:
+            with mmap.mmap(
+                f.fileno(), size - n, access=mmap.ACCESS_READ, offset=n
+            ) as mm:
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+                m.update(mm)
         return m.hexdigest()
 
 
@@ -77,39 +179,54 @@ def _is_regular(path):
     return os.path.isfile(path) and not os.path.islink(path)
 
 
-def _encapsulate(name, prefix=""):
-    escaped = name.replace("'", "'\\''")
-    return f"'{os.path.join(prefix, escaped)}'"
+def _prefix_slash(prefix):
+    """Normalize <prefix> so that it can be directly concatenated with a name."""
+    return prefix.rstrip("/") + "/" if prefix else ""
+
+
+def _encapsulate(name, prefix_slash=""):
+    # NOTE: <prefix_slash> is expected to be normalized by _prefix_slash
+    return "'" + prefix_slash + name.replace("'", "'\\''") + "'"
 
 
 def _decapsulate(name):
     return name[1:-1].replace("'\\''", "'")
 
 
-def _path_stat(base, path):
-    return os.lstat(os.path.join(base, path))  # NOTE: lstat doesn't follow symlink
+# return "mode,uid,gid[,nlink]" of the given stat result
+def _join_mode_uid_gid(stat, nlink=False):
+    # NOTE: "%04o" of the permission bits equals to oct(st_mode)[-4:]
+    if nlink:
+        return "%04o,%d,%d,%d" % (
+            stat.st_mode & 0o7777,
+            stat.st_uid,
+            stat.st_gid,
+            stat.st_nlink,
+        )
+    return "%04o,%d,%d" % (stat.st_mode & 0o7777, stat.st_uid, stat.st_gid)
+
 
+def _open_output(path):
+    return open(path, "w", buffering=OUTPUT_BUFFER_SIZE, newline="\n")
 
-# return array of mode, uid and gid
-def _path_mode_uid_gid(base, path, nlink=False):
-    stat = _path_stat(base, path)
-    if not nlink:
-        return [oct(stat.st_mode)[-4:], str(stat.st_uid), str(stat.st_gid)]
-    else:
-        return [
-            oct(stat.st_mode)[-4:],
-            str(stat.st_uid),
-            str(stat.st_gid),
-            str(stat.st_nlink),
-        ]
 
+class _LineWriter:
+    """Write lines to <f> separated by (but not terminated with) newline."""
+
+    def __init__(self, f):
+        self._f = f
+        self._sep = ""
 
-def _join_mode_uid_gid(base, path, nlink=False):
-    return ",".join(_path_mode_uid_gid(base, path, nlink=nlink))
+    def write(self, line):
+        # NOTE: one write call per line, the separator is prepended to the line
+        self._f.write(self._sep + line)
+        self._sep = "\n"
 
 
 def ignore_rules(target_dir, ignore_file):
     parser = igittigitt.IgnoreParser()
+    if not ignore_file:  # nothing is ignored
+        return parser
     with open(ignore_file) as f:
         for line in f:
             line = line.rstrip("\n")
@@ -117,22 +234,166 @@ def ignore_rules(target_dir, ignore_file):
     return parser
 
 
-def _get_latest_kernel_version(boot_dir: Path):
-    kfiles_path = str(boot_dir / "vmlinuz-*.*.*-*-*")
-
-    pa = re.compile(r"vmlinuz-(?P<version>\d+\.\d+\.\d+-\d+)(?P<suffix>.*)")
+class _IgnoreMatcher:
+    """Match paths against the rules of an igittigitt.IgnoreParser.
+
+    Unanchored rules on a plain name (i.e., "__pycache__/", ".git/") or on an
+    extension (i.e., "*.pyc") are checked with set lookups and str.endswith.
+    The other rules of each group are translated once into a single regular
+    expression, instead of running wcmatch.glob.globmatch per rule for every
+    path. The semantics follow IgnoreParser.match: directory-only rules don't
+    apply to files, and a path matched by any negation rule is not ignored.
+    """
+
+    _GLOB_FLAGS = wcmatch.glob.DOTGLOB | wcmatch.glob.GLOBSTAR
+    _GLOB_MAGIC = re.compile(r"[*?\[\\]")
+    _CHILDREN_GLOB = "/**/*"
+
+    def __init__(self, parser: igittigitt.IgnoreParser, base_dir):
+        base_dir = os.path.abspath(base_dir)
+        self.negation_rules = parser.negation_rules
+        self._base_len = len(base_dir) + 1
+
+        self._names, self._dir_names, self._parent_names = set(), set(), set()
+        suffixes, parent_suffixes = [], []
+        file_globs, dir_globs = [], []
+        unanchored = f"{base_dir}/**/"
+        for rule in parser.rules:
+            pattern = rule.pattern_glob
+            name, children = "", False
+            if pattern.startswith(unanchored):
+                name = pattern[len(unanchored) :]
+                if name.endswith(self._CHILDREN_GLOB):
+                    name, children = name[: -len(self._CHILDREN_GLOB)], True
+            if not name or "/" in name:
+                (file_globs if rule.match_file else dir_globs).append(pattern)
+            elif not self._GLOB_MAGIC.search(name):
+                if children:
+                    self._parent_names.add(name)
+                elif rule.match_file:
+                    self._names.add(name)
+                else:
+                    self._dir_names.add(name)
+            elif (
+                name.startswith("*.")
+                and not self._GLOB_MAGIC.search(name, 1)
+                and rule.match_file
+            ):
+                (parent_suffixes if children else suffixes).append(name[1:])
+            else:
+                (file_globs if rule.match_file else dir_globs).append(pattern)
+        self._suffixes = tuple(suffixes)
+        self._parent_suffixes = tuple(parent_suffixes)
+
+        self._file_re = self._compile(file_globs)
+        self._any_re = self._compile(file_globs + dir_globs)
+        self._negation_re = self._compile(r.pattern_glob for r in parser.negation_rules)
+
+    @classmethod
+    def _compile(cls, patterns):
+        patterns = list(patterns)
+        if not patterns:
+            return None
+        include, _ = wcmatch.glob.translate(patterns, flags=cls._GLOB_FLAGS)
+        return re.compile("|".join(f"(?:{r})" for r in include))
+
+    def _match_names(self, path: str, is_file: bool) -> bool:
+        *parents, name = path[self._base_len :].split("/")
+        if name in self._names or name.endswith(self._suffixes):
+            return True
+        if not is_file and name in self._dir_names:
+            return True
+        if not self._parent_names.isdisjoint(parents):
+            return True
+        return bool(self._parent_suffixes) and any(
+            p.endswith(self._parent_suffixes) for p in parents
+        )
 
-    def compare(left, right):
-        ma_l = pa.match(Path(left).name)
-        ma_r = pa.match(Path(right).name)
-        ver_l = version.parse(ma_l["version"])
-        ver_r = version.parse(ma_r["version"])
-        return 1 if ver_l > ver_r else -1
+    def match(self, path: str, is_file: bool) -> bool:
+        """Return True if absolute <path> under the base dir is ignored."""
+        regex = self._file_re if is_file else self._any_re
+        if not (self._match_names(path, is_file) or (regex and regex.fullmatch(path))):
+            return False
+        return not (self._negation_re and self._negation_re.fullmatch(path))
+
+
+def _walk(target_dir, ignore):
+    """Yield (DirEntry, relative path) for every entry under <target_dir>.
+
+    Entries matched by <ignore> are skipped. Ignored directories are not
+    descended into, unless negation rules might re-include a path under them.
+    """
+    target_abs = os.path.abspath(target_dir)
+    prune_ignored_dirs = not ignore.negation_rules
+
+    stack = [(target_dir, "")]
+    while stack:
+        dir_path, dir_rel = stack.pop()
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                rel = os.path.join(dir_rel, entry.name)
+                is_dir = entry.is_dir(follow_symlinks=False)
+                try:
+                    # NOTE: like Path.is_file, follow symlinks to decide whether
+                    #       directory-only rules apply
+                    ignored = ignore.match(
+                        os.path.join(target_abs, rel), entry.is_file()
+                    )
+                except OSError as e:  # i.e., symlink loop
+                    print(f"WARN: {e}")
+                    ignored = False
+                if ignored:
+                    if is_dir and not prune_ignored_dirs:
+                        stack.append((entry.path, rel))
+                    continue
+                yield entry, rel
+                if is_dir:
+                    stack.append((entry.path, rel))
+
+
+# i.e., vmlinuz-5.15.0-64-generic: version="5.15.0-64", suffix="-generic"
+_VMLINUZ_RE = re.compile(
+    r"vmlinuz-(?P<version>(?P<major>\d+)\.(?P<minor>\d+)\.(?P<patch>\d+)-(?P<abi>\d+))"
+    r"(?P<suffix>.*)"
+)
+_VERSION_FIELDS = ("major", "minor", "patch", "abi")
+
+
+# same as globbing "<kind>-*.*.*-*-*" for each kind of kernel file
+_KERNEL_FILE_RE = re.compile(
+    r"(?P<kind>vmlinuz|initrd\.img|System\.map|config)-.*\..*\..*-.*-.*", re.DOTALL
+)
+_KERNEL_FILE_KINDS = ("vmlinuz", "initrd.img", "System.map", "config")
+
+
+def _scan_kernel_files(boot_dir: Path):
+    """Return the non-symlink kernel files under <boot_dir> by kind.
+
+    The directory is listed once with os.scandir, instead of globbing it once
+    per kind and checking every match with another lstat.
+    """
+    kernel_files = {kind: [] for kind in _KERNEL_FILE_KINDS}
+    with os.scandir(boot_dir) as it:
+        for entry in it:
+            ma = _KERNEL_FILE_RE.fullmatch(entry.name)
+            if ma and not entry.is_symlink():
+                kernel_files[ma["kind"]].append(entry.path)
+    return kernel_files
+
+
+def _latest_vmlinuz(vmlinuz_files):
+    # NOTE: parse the version of each kernel only once, and compare the versions
+    #       as int tuples, i.e., (5, 15, 0, 64) for vmlinuz-5.15.0-64-generic.
+    kfiles = []
+    for f in vmlinuz_files:
+        if ma := _VMLINUZ_RE.match(os.path.basename(f)):
+            kfiles.append((tuple(map(int, ma.group(*_VERSION_FIELDS))), f))
+
+    return Path(max(kfiles)[1])  # latest
 
-    kfile_glob = [f for f in glob.glob(kfiles_path) if not Path(f).is_symlink()]
-    kfiles = sorted(kfile_glob, key=cmp_to_key(compare), reverse=True)
 
-    return Path(kfiles[0])  # latest
+def _get_latest_kernel_version(boot_dir: Path):
+    return _latest_vmlinuz(_scan_kernel_files(boot_dir)["vmlinuz"])
 
 
 def _list_non_latest_kernels(boot_dir: Path):
@@ -141,36 +402,168 @@ def _list_non_latest_kernels(boot_dir: Path):
     if (boot_dir / "extlinux" / "extlinux.conf").is_file():
         return []
 
-    kfiles_path = str(boot_dir / "vmlinuz-*.*.*-*-*")
-    ifiles_path = str(boot_dir / "initrd.img-*.*.*-*-*")
-    sfiles_path = str(boot_dir / "System.map-*.*.*-*-*")
-    cfiles_path = str(boot_dir / "config-*.*.*-*-*")
-
-    kfile_glob = [f for f in glob.glob(kfiles_path) if not Path(f).is_symlink()]
-    ifile_glob = [f for f in glob.glob(ifiles_path) if not Path(f).is_symlink()]
-    sfile_glob = [f for f in glob.glob(sfiles_path) if not Path(f).is_symlink()]
-    cfile_glob = [f for f in glob.glob(cfiles_path) if not Path(f).is_symlink()]
+    kernel_files = _scan_kernel_files(boot_dir)
 
-    pa = re.compile(r"vmlinuz-(?P<version>\d+\.\d+\.\d+-\d+)(?P<suffix>.*)")
-    vmlinuz = _get_latest_kernel_version(boot_dir)
-    k_ma = pa.match(vmlinuz.name)
+    vmlinuz = _latest_vmlinuz(kernel_files["vmlinuz"])
+    k_ma = _VMLINUZ_RE.match(vmlinuz.name)
     ver = k_ma["version"]  # type: ignore
     suf = k_ma["suffix"]  # type: ignore
     initrd_img = vmlinuz.parent / f"initrd.img-{ver}{suf}"
-    system_map = vmlinuz.parent / f"System.map-{ver}{suf}"
-    config = vmlinuz.parent / f"config-{ver}{suf}"
+    system_map = vmlinuz.parent / f"System.map-{ver}{suf}"  # optional
+    config = vmlinuz.parent / f"config-{ver}{suf}"  # optional
 
-    if str(initrd_img) not in ifile_glob:  # initrd.img-{ver}{suf} must exist.
+    if str(initrd_img) not in kernel_files["initrd.img"]:  # must exist.
         raise Exception(f"{initrd_img} doesn't exist.")
 
-    kfile_glob.remove(str(vmlinuz))
-    ifile_glob.remove(str(initrd_img))
+    latest = {str(vmlinuz), str(initrd_img), str(system_map), str(config)}
+    return [
+        f for kind in _KERNEL_FILE_KINDS for f in kernel_files[kind] if f not in latest
+    ]
+
+
+# mode,uid,gid,link number,sha256sum,'path/to/file',size,inode,[compress_alg]
+# NOTE: the whole line is rendered by one % operation, see _join_mode_uid_gid
+_REGULAR_LINE_FORMAT = "%04o,%d,%d,%d,%s,%s,%d,%s,%s"
+
+
+def _hash_cache_key(stat):
+    # NOTE: any write to the file updates its mtime and ctime, and ctime can't be
+    #       set back from userspace
+    return "%d:%d:%d:%d:%d" % (
+        stat.st_dev,
+        stat.st_ino,
+        stat.st_size,
+        stat.st_mtime_ns,
+        stat.st_ctime_ns,
+    )
+
+
+_SHA256_HEX_RE = re.compile(r"[0-9a-f]{64}")
+
+
+def _load_hash_cache(path):
+    # NOTE: the cache is only a speed-up, a missing or broken cache is empty
     try:
-        sfile_glob.remove(str(system_map))  # system_map is optional
-        cfile_glob.remove(str(config))  # config is optional
-    except ValueError:
-        pass
-    return kfile_glob + ifile_glob + sfile_glob + cfile_glob
+        with open(path) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"WARN: ignore broken hash cache {path}: {e!r}")
+        return {}
+    if not isinstance(cache, dict):
+        print(f"WARN: ignore broken hash cache {path}")
+        return {}
+    # NOTE: a cached value is written to regulars.txt as is, so only take sha256s
+    hashes = {}
+    for key, value in cache.items():
+        if isinstance(value, str) and _SHA256_HEX_RE.fullmatch(value):
+            hashes[key] = value
+        else:
+            print(f"WARN: ignore broken hash cache entry {key}: {value!r}")
+    return hashes
+
+
+def _save_hash_cache(path, hashes):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(hashes, f, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def _zstd_compress_pooled(compressors: queue.Queue, src, dst, **kwargs):
+    """zstd_compress_file with a compressor borrowed from <compressors>."""
+    # NOTE: ZstdCompressor is not thread-safe, so each one is used by one thread
+    #       at a time. Waiting for a free one bounds the number of concurrent
+    #       compressions, and so the memory held by the compressors.
+    cctx = compressors.get()
+    try:
+        return zstd_compress_file(cctx, src, dst, **kwargs)
+    finally:
+        compressors.put(cctx)
+
+
+def _process_regular(
+    target_dir,
+    d,
+    *,
+    prefix_slash,
+    compressed_dir,
+    compressors,
+    cmpr_ratio,
+    filesize_threshold,
+    hardlinks,
+    prev_hashes=None,
+    hashes=None,
+):
+    """Hash (and compress) regular file <d>, return its regulars.txt line and size.
+
+    <hardlinks> maps (st_dev, st_ino) of already processed files with more than
+    one link to their sha256 hash and compression algorithm.
+    If <hashes> is given, the sha256 hash is stored in it by _hash_cache_key, and
+    reused from <prev_hashes> of the previous run when the file is unchanged.
+    """
+    src = os.path.join(target_dir, d)
+    # NOTE: lstat doesn't follow symlink
+    stat = os.lstat(src)
+    size = stat.st_size
+    nlink = stat.st_nlink
+    inode = stat.st_ino if nlink > 1 else ""
+    # NOTE: hard links share the same content, only process it once per inode
+    if nlink > 1 and (processed := hardlinks.get((stat.st_dev, stat.st_ino))):
+        sha256hash, compress_alg = processed
+    else:
+        cache_key = _hash_cache_key(stat) if hashes is not None else None
+        if not (sha256hash := prev_hashes and prev_hashes.get(cache_key)):
+            # NOTE: keep the file cached if it's going to be read again for
+            #       compression
+            sha256hash = _file_sha256(
+                src, drop_cache=not compressed_dir or size < filesize_threshold
+            )
+        if hashes is not None:
+            hashes[cache_key] = sha256hash
+
+        # if compression is enabled, try to compress the file here
+        compress_alg = ""
+        if compressed_dir and size >= filesize_threshold:
+            dst_f = os.path.join(
+                compressed_dir, f"{sha256hash}.{ZSTD_COMPRESSION_EXTENSION}"
+            )  # add zstd extension to filename
+            # NOTE: skip already compressed file
+            if os.path.exists(dst_f) or _zstd_compress_pooled(
+                compressors,
+                src,
+                dst_f,
+                cmpr_ratio=cmpr_ratio,
+                filesize_threshold=filesize_threshold,
+            ):
+                compress_alg = ZSTD_COMPRESSION_EXTENSION
+        if nlink > 1:
+            hardlinks[(stat.st_dev, stat.st_ino)] = sha256hash, compress_alg
+
+    line = _REGULAR_LINE_FORMAT % (
+        stat.st_mode & 0o7777,
+        stat.st_uid,
+        stat.st_gid,
+        nlink,
+        sha256hash,
+        _encapsulate(d, prefix_slash),
+        size,
+        inode,
+        compress_alg,  # ensure the compress_alg is at the end
+    )
+    return line, size
+
+
+def _ordered_map(executor, fn, iterable, *, max_pending):
+    """Like executor.map, but keeps at most <max_pending> tasks in flight."""
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
 
 
 def gen_metadata(
@@ -186,117 +579,150 @@ def gen_metadata(
     *,
     cmpr_ratio: float,
     filesize_threshold: int,
+    zstd_level: int = ZSTD_COMPRESSION_LEVEL,
+    zstd_window_log: int = ZSTD_WINDOW_LOG,
+    workers: int = DEFAULT_WORKERS,
+    compress_workers: int = DEFAULT_COMPRESS_WORKERS,
+    zstd_threads: int = ZSTD_MULTITHREADS,
+    hash_cache=None,
 ):
-    p = Path(target_dir)
-    target_abs = Path(os.path.abspath(target_dir))
-    ignore = ignore_rules(target_dir, ignore_file)
+    """Generate the metadata of <target_dir>.
+
+    Paths matching the .gitignore style rules in <ignore_file> are skipped. If
+    <ignore_file> is None, nothing is ignored.
+
+    Regular files are hashed by <workers> threads, and at most
+    <compress_workers> of them are compressed at once. <zstd_threads> is the
+    number of zstd threads of each compressor, -1 for all the CPUs. The memory
+    of each compressor grows with its number of threads.
+
+    If <hash_cache> is given, the sha256 hashes are saved to that file, and
+    files unchanged since the previous run (same device, inode, size, mtime and
+    ctime) are not hashed again.
+    """
+    if workers < 1 or compress_workers < 1:
+        raise ValueError(
+            f"workers ({workers}) and compress_workers ({compress_workers}) "
+            "must be at least 1"
+        )
+    ignore = _IgnoreMatcher(ignore_rules(target_dir, ignore_file), target_dir)
+    prefix_slash = _prefix_slash(prefix)
 
     # remove kernels under /boot directory other than latest
-    non_latest_kernels = _list_non_latest_kernels(p / "boot")
+    # NOTE: kernel files are listed directly under <target_dir>/boot
+    non_latest_kernels = {
+        os.path.join("boot", os.path.basename(k))
+        for k in _list_non_latest_kernels(Path(target_dir) / "boot")
+    }
 
-    dirs = []
-    symlinks = []
-    regulars = []
-    for f in p.glob("**/*"):
-        try:
-            if ignore.match(target_abs / str(f.relative_to(target_dir))):
-                continue
-            if str(f) in non_latest_kernels:
-                print(f"INFO: {f} is not a latest kernel. skip.")
-                continue
-        except Exception as e:
-            if str(e).startswith("Symlink loop from"):
-                print(f"WARN: {e}")
-            else:
-                raise
-        if f.is_dir() and not f.is_symlink():
-            dirs.append(str(f.relative_to(target_dir)))
-        if f.is_symlink():
-            symlinks.append(str(f.relative_to(target_dir)))
-        if f.is_file() and not f.is_symlink():
-            regulars.append(str(f.relative_to(target_dir)))
+    # compression with zstd
+    #   store the compressed file with its original file's hash and .zstd ext as name,
+    #   directly under the <compressed_dir>
+    compressors = None
+    if compressed_dir:
+        os.makedirs(compressed_dir, exist_ok=True)
+        compress_workers = min(compress_workers, workers)
+        compression_params = zstandard.ZstdCompressionParameters(
+            compression_level=zstd_level,
+            window_log=zstd_window_log,
+            # NOTE: the compressed output doesn't depend on the number of
+            #       zstd threads.
+            threads=zstd_threads,
+        )
+        compressors = queue.Queue()
+        for _ in range(compress_workers):
+            compressors.put(
+                zstandard.ZstdCompressor(compression_params=compression_params)
+            )
 
     # dirs.txt
     # format:
     # mode,uid,gid,'dir/name'
     # ex: 0755,1000,1000,'path/to/dir'
-    with open(os.path.join(output_dir, directory_file), "w") as _f:
-        dirs_list = [
-            f"{_join_mode_uid_gid(target_dir, d)},{_encapsulate(d, prefix=prefix)}"
-            for d in dirs
-        ]
-        _f.writelines("\n".join(dirs_list))
-
+    #
     # symlinks.txt
     # format:
     # mode,uid,gid,'path/to/link','path/to/target'
     # ex: 0777,1000,1000,'path/to/link','path/to/target'
     # NOTE: mode is always 0777.
-    with open(os.path.join(output_dir, symlink_file), "w") as _f:
-        symlink_list = [
-            f"{_join_mode_uid_gid(target_dir, d)},"
-            f"{_encapsulate(d, prefix=prefix)},"
-            f"{_encapsulate(os.readlink(os.path.join(target_dir, d)))}"
-            for d in symlinks
-        ]
-        _f.writelines("\n".join(symlink_list))
-
-    # compression with zstd
-    #   store the compressed file with its original file's hash and .zstd ext as name,
-    #   directly under the <compressed_dir>
-    if compressed_dir:
-        os.makedirs(compressed_dir, exist_ok=True)
-        cctx = zstandard.ZstdCompressor(
-            level=ZSTD_COMPRESSION_LEVEL, threads=ZSTD_MULTITHREADS
-        )
-
+    #
     # regulars.txt
     # format:
     # mode,uid,gid,link number,sha256sum,'path/to/file',size,inode,[compress_alg]
     # ex: 0644,1000,1000,1,0123456789abcdef0123456789abcdef0123456789abcdef0123456789abcdef,'path/to/file',1234,12345678,[zst]
+    def _walk_regulars(dirs_w, symlinks_w):
+        """Write the dirs and symlinks lines while walking, and yield regulars."""
+        for entry, rel in _walk(target_dir, ignore):
+            if rel in non_latest_kernels:
+                print(f"INFO: {entry.path} is not a latest kernel. skip.")
+                continue
+            # NOTE: DirEntry caches the file type, so no extra stat is issued here
+            if entry.is_symlink():
+                symlinks_w.write(
+                    f"{_join_mode_uid_gid(os.lstat(entry.path))},"
+                    f"{_encapsulate(rel, prefix_slash)},"
+                    f"{_encapsulate(os.readlink(entry.path))}"
+                )
+            elif entry.is_dir(follow_symlinks=False):
+                dirs_w.write(
+                    f"{_join_mode_uid_gid(os.lstat(entry.path))},"
+                    f"{_encapsulate(rel, prefix_slash)}"
+                )
+            elif entry.is_file(follow_symlinks=False):
+                yield rel
+
     total_regular_size = 0
 
-    with open(os.path.join(output_dir, regular_file), "w") as _f:
-
-        regular_list = []
-        for d in regulars:
-            size = os.path.getsize(os.path.join(target_dir, d))
-            stat = os.stat(os.path.join(target_dir, d))
-            nlink = stat.st_nlink
-            inode = stat.st_ino if nlink > 1 else ""
-            sha256hash = _file_sha256(os.path.join(target_dir, d))
-
-            # if compression is enabled, try to compress the file here
-            compress_alg = ""
-            if compressed_dir:
-                src_f = os.path.join(target_dir, d)
-                dst_f = os.path.join(
-                    compressed_dir, f"{sha256hash}.{ZSTD_COMPRESSION_EXTENSION}"
-                )  # add zstd extension to filename
-                # NOTE: skip already compressed file
-                if os.path.exists(dst_f) or zstd_compress_file(
-                    cctx,  # type: ignore
-                    src_f,
-                    dst_f,
-                    cmpr_ratio=cmpr_ratio,
-                    filesize_threshold=filesize_threshold,
-                ):
-                    compress_alg = ZSTD_COMPRESSION_EXTENSION
-
-            regular_list.append(
-                f"{_join_mode_uid_gid(target_dir, d, nlink=True)},"
-                f"{sha256hash},"
-                f"{_encapsulate(d, prefix=prefix)},"
-                f"{size},"
-                f"{inode},"
-                f"{compress_alg}"  # ensure the compress_alg is at the end
-            )
+    # NOTE: hashing and compression are done in C code which releases the GIL,
+    #       so the regular files are processed by a thread pool. The tree is
+    #       walked only once, and every line is written out as soon as it's
+    #       ready, in walk order, so no list of entries is kept in memory.
+    process_regular = partial(
+        _process_regular,
+        target_dir,
+        prefix_slash=prefix_slash,
+        compressed_dir=compressed_dir,
+        compressors=compressors,
+        cmpr_ratio=cmpr_ratio,
+        filesize_threshold=filesize_threshold,
+        hardlinks={},
+    )
+    if hash_cache:
+        hashes = {}
+        process_regular = partial(
+            process_regular, prev_hashes=_load_hash_cache(hash_cache), hashes=hashes
+        )
+    with ExitStack() as stack:
+        executor = stack.enter_context(ThreadPoolExecutor(max_workers=workers))
+        dirs_w, symlinks_w, regulars_w = (
+            _LineWriter(stack.enter_context(_open_output(os.path.join(output_dir, f))))
+            for f in (directory_file, symlink_file, regular_file)
+        )
+        for line, size in _ordered_map(
+            executor,
+            process_regular,
+            _walk_regulars(dirs_w, symlinks_w),
+            max_pending=workers * 4,
+        ):
+            regulars_w.write(line)
             total_regular_size += size
-        _f.writelines("\n".join(regular_list))
 
     with open(os.path.join(output_dir, total_regular_size_file), "w") as _f:
         _f.write(str(total_regular_size))
 
+    if hash_cache:
+        _save_hash_cache(hash_cache, hashes)
+
+
+def _positive_int(value):
+    try:
+        n = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid int value: {value!r}")
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1: {value}")
+    return n
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -318,6 +744,53 @@ if __name__ == "__main__":
         default=16 * 1024,  # 16KiB
         type=int,
     )
+    parser.add_argument(
+        "--zstd-level",
+        help="zstd compression level. lower levels compress faster.",
+        default=ZSTD_COMPRESSION_LEVEL,
+        type=int,
+    )
+    parser.add_argument(
+        "--zstd-window-log",
+        help=(
+            "zstd window size as power of 2, 0 for the default of the level. "
+            "decompression requires up to 2**window_log bytes of memory, "
+            "and each compressor several times as much."
+        ),
+        default=ZSTD_WINDOW_LOG,
+        type=int,
+    )
+    parser.add_argument(
+        "--workers",
+        help="number of threads to hash regular files.",
+        default=DEFAULT_WORKERS,
+        type=_positive_int,
+    )
+    parser.add_argument(
+        "--compress-workers",
+        help=(
+            "number of files compressed at once. "
+            "each compressor holds its own zstd threads and window."
+        ),
+        default=DEFAULT_COMPRESS_WORKERS,
+        type=_positive_int,
+    )
+    parser.add_argument(
+        "--zstd-threads",
+        help=(
+            "number of zstd threads of each compressor, -1 for all the CPUs. "
+            "the memory of each compressor grows with its number of threads."
+        ),
+        default=ZSTD_MULTITHREADS,
+        type=int,
+    )
+    parser.add_argument(
+        "--hash-cache",
+        help=(
+            "file to keep sha256 hashes in between runs. "
+            "unchanged files are not hashed again."
+        ),
+    )
     parser.add_argument("--prefix", help="file name prefix.", default="/")
     parser.add_argument("--output-dir", help="metadata output directory.", default=".")
     parser.add_argument(
@@ -352,4 +825,10 @@ if __name__ == "__main__":
         ignore_file=args.ignore_file,
         cmpr_ratio=args.compress_ratio,
         filesize_threshold=args.compress_filesize,
+        zstd_level=args.zstd_level,
+        zstd_window_log=args.zstd_window_log,
+        workers=args.workers,
+        compress_workers=args.compress_workers,
+        zstd_threads=args.zstd_threads,
+        hash_cache=args.hash_cache,
     )
@@ -15,20 +15,32 @@
 # limitations under the License.
 
 
+import os
 from os.path import basename, isfile
 from hashlib import sha256
 import base64
 import argparse
 import json
+import mmap
+from concurrent.futures import ThreadPoolExecutor
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import ec
 
+MMAP_THRESHOLD = 10 * (1024**2)  # 10MiB
+
 
 def _file_sha256(filename):
     with open(filename, "rb") as f:
-        digest = sha256(f.read()).hexdigest()
-        return digest
+        # NOTE: large metadata files (i.e., regulars.txt of a big rootfs) are
+        #       hashed directly from the page cache instead of being read into
+        #       memory at once.
+        if os.fstat(f.fileno()).st_size >= MMAP_THRESHOLD:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # read ahead aggressively, the file is read once from start to end
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+                return sha256(mm).hexdigest()
+        return sha256(f.read()).hexdigest()
 
 
 def urlsafe_b64encode(data):
@@ -37,8 +49,12 @@ def urlsafe_b64encode(data):
     return base64.urlsafe_b64encode(data).decode()
 
 
+# the JWT header is constant
+_HEADER = urlsafe_b64encode(json.dumps({"alg": "ES256"}))
+
+
 def gen_header():
-    return urlsafe_b64encode(json.dumps({"alg": "ES256"}))
+    return _HEADER
 
 
 def gen_payload(
@@ -51,20 +67,32 @@ def gen_payload(
     total_regular_size_file,
     compressed_rootfs_directory,
 ):
+    # NOTE: the files are hashed in parallel, hashlib releases the GIL while
+    #       hashing large buffers.
+    files = (
+        directory_file,
+        symlink_file,
+        regular_file,
+        persistent_file,
+        certificate_file,
+    )
+    with ThreadPoolExecutor(max_workers=len(files)) as executor:
+        (
+            directory_hash,
+            symlink_hash,
+            regular_hash,
+            persistent_hash,
+            certificate_hash,
+        ) = executor.map(_file_sha256, files)
+
     payload = [
         {"version": 1},
-        {"directory": basename(directory_file), "hash": _file_sha256(directory_file)},
-        {"symboliclink": basename(symlink_file), "hash": _file_sha256(symlink_file)},
-        {"regular": basename(regular_file), "hash": _file_sha256(regular_file)},
-        {
-            "persistent": basename(persistent_file),
-            "hash": _file_sha256(persistent_file),
-        },
+        {"directory": basename(directory_file), "hash": directory_hash},
+        {"symboliclink": basename(symlink_file), "hash": symlink_hash},
+        {"regular": basename(regular_file), "hash": regular_hash},
+        {"persistent": basename(persistent_file), "hash": persistent_hash},
         {"rootfs_directory": rootfs_directory},
-        {
-            "certificate": basename(certificate_file),
-            "hash": _file_sha256(certificate_file),
-        },
+        {"certificate": basename(certificate_file), "hash": certificate_hash},
     ]
     if isfile(total_regular_size_file):
         total_regular_size = open(total_regular_size_file).read()
@@ -74,12 +102,24 @@ def gen_payload(
     return urlsafe_b64encode(json.dumps(payload))
 
 
-def sign(sign_key_file, data):
+def _load_key(sign_key_file):
     with open(sign_key_file, "rb") as f:
-        priv = serialization.load_pem_private_key(f.read(), password=None)
+        key = f.read()
+    # NOTE: a DER key is an ASN.1 SEQUENCE, i.e., starts with 0x30, while a PEM
+    #       key starts with "-----BEGIN".
+    if key.startswith(b"\x30"):
+        return serialization.load_der_private_key(key, password=None)
+    return serialization.load_pem_private_key(key, password=None)
+
+
+def _sign(priv, data):
     return urlsafe_b64encode(priv.sign(data.encode(), ec.ECDSA(hashes.SHA256())))
 
 
+def sign(sign_key_file, data):
+    return _sign(_load_key(sign_key_file), data)
+
+
 def sign_metadata(
     directory_file,
     symlink_file,
@@ -92,6 +132,8 @@ def sign_metadata(
     compressed_rootfs_directory,
     output_file,
 ):
+    # NOTE: load the key before hashing, so that a bad key fails early.
+    priv = _load_key(sign_key_file)
     header = gen_header()
     payload = gen_payload(
         directory_file,
@@ -103,7 +145,7 @@ def sign_metadata(
         total_regular_size_file,
         compressed_rootfs_directory,
     )
-    signature = sign(sign_key_file, f"{header}.{payload}")
+    signature = _sign(priv, f"{header}.{payload}")
     with open(output_file, "w") as f:
         f.write(f"{header}.{payload}.{signature}")
 
@@ -0,0 +1,39 @@
+# Copyright 2022 TIER IV, INC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import pytest
+
+_shm_basetemp = None
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_configure(config):
+    # NOTE: the tests create many small files, setting PYTEST_SHM (e.g., to
+    #       /dev/shm) keeps them on tmpfs. This is opt-in, as one run writes
+    #       ~50MB and a container's /dev/shm may be much smaller. Each run gets
+    #       its own private directory, which is removed unless the run failed.
+    #       --basetemp takes precedence.
+    global _shm_basetemp
+    shm = os.environ.get("PYTEST_SHM")
+    if shm and config.option.basetemp is None:
+        _shm_basetemp = tempfile.mkdtemp(prefix="pytest-ota-metadata-", dir=shm)
+        config.option.basetemp = _shm_basetemp
+
+
+def pytest_sessionfinish(session, exitstatus):
+    if _shm_basetemp and exitstatus == 0:
+        shutil.rmtree(_shm_basetemp, ignore_errors=True)
@@ -12,67 +12,601 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from pytest_unordered import unordered
+import os
+import json
+import itertools
+import hashlib
+import pytest
+import zstandard
+import igittigitt
 
+import metadata_gen
 
-def test_get_latest_kernel_version(tmp_path):
-    import metadata_gen
 
-    vmlinuzs = [
-        "vmlinuz-5.15.0-27-generic",
-        "vmlinuz-5.15.0-64-generic",
-        "vmlinuz-5.4.0-102-generic",
-        "vmlinuz-4.12.0-27-generic",
+def _write_file(path, text=""):
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def _touch_many(root, names):
+    """Create empty files <names> under <root>."""
+    for name in names:
+        os.close(os.open(os.path.join(root, name), os.O_WRONLY | os.O_CREAT, 0o644))
+
+
+def _read_file(path):
+    with open(path) as f:
+        return f.read()
+
+
+def _run_gen_metadata(
+    root,
+    target_dir,
+    *,
+    output="output",
+    compressed_dir=None,
+    ignore_file=None,
+    cmpr_ratio=1.25,
+    filesize_threshold=1,
+    **kwargs,
+):
+    """Run gen_metadata on <target_dir>, return the output directory.
+
+    The metadata is written under <root>/<output> with the default file names.
+    """
+    output_dir = os.path.join(root, output)
+    os.makedirs(output_dir, exist_ok=True)
+    metadata_gen.gen_metadata(
+        target_dir,
+        compressed_dir,
+        "/",
+        output_dir,
+        directory_file="dirs.txt",
+        symlink_file="symlinks.txt",
+        regular_file="regulars.txt",
+        total_regular_size_file="total_regular_size.txt",
+        ignore_file=ignore_file,
+        cmpr_ratio=cmpr_ratio,
+        filesize_threshold=filesize_threshold,
+        **kwargs,
+    )
+    return output_dir
+
+
+def _regular_paths(path):
+    """Return the 'path' -> sha256 of each line of regulars.txt at <path>."""
+    regulars = {}
+    with open(path) as f:
+        # mode,uid,gid,nlink,sha256,'path',size,inode,compress_alg
+        # NOTE: none of the paths in the tests contain a comma
+        for line in f.read().splitlines():
+            _, _, _, _, sha256hash, rest = line.split(",", 5)
+            regulars[rest.rsplit(",", 3)[0]] = sha256hash
+    return regulars
+
+
+KERNEL_VERSIONS = [
+    "5.15.0-27-generic",
+    "5.15.0-64-generic",
+    "5.15.0-100-generic",  # latest, though not by string order
+    "5.15.0-9-generic",
+    "5.4.0-102-generic",
+    "5.9.0-999-generic",
+    "4.12.0-27-generic",
+]
+
+
+@pytest.fixture(scope="module")
+def kernel_tree(tmp_path_factory):
+    """Boot folder shared by the kernel tests, which only read it."""
+    boot_dir = tmp_path_factory.mktemp("boot")
+    _touch_many(
+        str(boot_dir),
+        [f"vmlinuz-{v}" for v in KERNEL_VERSIONS]
+        + [f"initrd.img-{v}" for v in KERNEL_VERSIONS]
+        # initrd.img without vmlinuz
+        + ["initrd.img-5.15.0-65-generic"],
+    )
+    return boot_dir
+
+
+def test_get_latest_kernel_version(kernel_tree):
+    latest = metadata_gen._get_latest_kernel_version(kernel_tree)
+    assert latest == kernel_tree / "vmlinuz-5.15.0-100-generic"
+
+
+def test_list_non_latest_kernels(kernel_tree):
+    latest = metadata_gen._list_non_latest_kernels(kernel_tree)
+
+    root = str(kernel_tree)
+    non_latest_versions = [v for v in KERNEL_VERSIONS if v != "5.15.0-100-generic"]
+    assert sorted(latest) == sorted(
+        [os.path.join(root, f"vmlinuz-{v}") for v in non_latest_versions]
+        + [os.path.join(root, f"initrd.img-{v}") for v in non_latest_versions]
+        + [os.path.join(root, "initrd.img-5.15.0-65-generic")]
+    )
+
+
+def test_list_non_latest_kernels_many(tmp_path):
+    # 10 * 10 * 10 * 10 kernels
+    versions = [
+        f"{major}.{minor}.{patch}-{abi}-generic"
+        for major, minor, patch, abi in itertools.product(
+            range(4, 14), range(10), range(10), range(90, 110, 2)
+        )
     ]
+    root = str(tmp_path)
+    _touch_many(
+        root,
+        [f"vmlinuz-{v}" for v in versions] + ["initrd.img-13.9.9-108-generic"],
+    )
+
+    latest = metadata_gen._list_non_latest_kernels(tmp_path)
+
+    assert len(latest) == len(versions) - 1
+    assert os.path.join(root, "vmlinuz-13.9.9-108-generic") not in latest
+
+
+def test_list_non_latest_kernels_optional_files(tmp_path):
+    root = str(tmp_path)
+    _touch_many(
+        root,
+        [
+            "vmlinuz-5.15.0-27-generic",
+            "vmlinuz-5.15.0-64-generic",  # latest kernel
+            "initrd.img-5.15.0-27-generic",
+            "initrd.img-5.15.0-64-generic",
+            "System.map-5.15.0-27-generic",
+            # System.map of the latest kernel is missing
+            "config-5.15.0-27-generic",
+            "config-5.15.0-64-generic",
+        ],
+    )
+    os.symlink("vmlinuz-5.15.0-27-generic", os.path.join(root, "vmlinuz-9.9.9-9-link"))
+
+    latest = metadata_gen._list_non_latest_kernels(tmp_path)
+
+    assert sorted(latest) == sorted(
+        [
+            os.path.join(root, "vmlinuz-5.15.0-27-generic"),
+            os.path.join(root, "initrd.img-5.15.0-27-generic"),
+            os.path.join(root, "System.map-5.15.0-27-generic"),
+            os.path.join(root, "config-5.15.0-27-generic"),
+        ]
+    )
 
-    for vmlinuz in vmlinuzs:
-        (tmp_path / vmlinuz).write_text("")
-    latest = metadata_gen._get_latest_kernel_version(tmp_path)
-    assert latest == tmp_path / "vmlinuz-5.15.0-64-generic"
 
+def test_list_non_latest_kernels_empty(tmp_path):
+    extlinux_dir = os.path.join(tmp_path, "extlinux")
+    os.mkdir(extlinux_dir)
+    _write_file(os.path.join(extlinux_dir, "extlinux.conf"))
+
+    non_latests = metadata_gen._list_non_latest_kernels(tmp_path)
+    assert non_latests == []
 
-def test_list_non_latest_kernels(tmp_path):
-    import metadata_gen
 
+@pytest.mark.parametrize("compress", [False, True])
+def test_gen_metadata_method(tmp_path, compress):
+    root = str(tmp_path)
+    target_dir = os.path.join(root, "rootfs")
+    # the metadata doesn't depend on compression, which is only checked once
+    compressed_dir = os.path.join(root, "data.zst") if compress else None
+    os.mkdir(target_dir)
+
+    boot_dir = os.path.join(target_dir, "boot")
+    os.mkdir(boot_dir)
     vmlinuzs = [
         "vmlinuz-5.15.0-27-generic",
         "vmlinuz-5.15.0-64-generic",  # latest kernel
-        "vmlinuz-5.4.0-102-generic",
-        "vmlinuz-4.12.0-27-generic",
     ]
-
     initrd_imgs = [
-        "initrd.img-5.15.0-65-generic",
-        "initrd.img-5.15.0-64-generic",  # <- other than this should be returned
-        "initrd.img-5.4.0-102-generic",
-        "initrd.img-4.12.0-27-generic",
+        "initrd.img-5.15.0-27-generic",
+        "initrd.img-5.15.0-64-generic",
     ]
+    _touch_many(boot_dir, vmlinuzs + initrd_imgs)
 
-    for vmlinuz in vmlinuzs:
-        (tmp_path / vmlinuz).write_text("")
+    proj_dir = os.path.join(target_dir, "home", "autoware", "autoware.proj")
+    build_folder = os.path.join(proj_dir, "build")
+    src_folder = os.path.join(proj_dir, "src")
+    install_folder = os.path.join(proj_dir, "install")
+    os.makedirs(build_folder)
+    os.mkdir(src_folder)
+    os.mkdir(install_folder)
 
-    for initrd_img in initrd_imgs:
-        (tmp_path / initrd_img).write_text("")
+    build_file1 = os.path.join(build_folder, "file_001")
+    build_file2 = os.path.join(build_folder, "file_002")
+    src_file1 = os.path.join(src_folder, "file_001")
+    src_file2 = os.path.join(src_folder, "file_002")
+    install_file0 = os.path.join(install_folder, "file_000")
+    _write_file(build_file1, "build_file1" * 100)
+    _write_file(build_file2, "build_file2" * 100)
+    _write_file(src_file1, "src_file1" * 100)
+    _write_file(src_file2, "src_file2" * 100)
+    _write_file(install_file0, "install_file0" * 100)
 
-    latest = metadata_gen._list_non_latest_kernels(tmp_path)
+    # symlinks into the ignored folders are kept, only their targets are ignored
+    install_fd = os.open(install_folder, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.symlink(os.path.abspath(build_file1), "file_001", dir_fd=install_fd)
+        os.symlink("../build/file_002", "file_002", dir_fd=install_fd)
+        os.symlink("../src/file_001", "file_003", dir_fd=install_fd)
+    finally:
+        os.close(install_fd)
+
+    ignore_file = os.path.join(root, "ignore.txt")
+    _write_file(
+        ignore_file,
+        "\n".join(
+            [
+                "home/autoware/autoware.proj/build",
+                "home/autoware/autoware.proj/src",
+            ]
+        ),
+    )
+
+    output_dir = _run_gen_metadata(
+        root, target_dir, compressed_dir=compressed_dir, ignore_file=ignore_file
+    )
+
+    # NOTE: none of the paths in this test contain a comma
+    with open(os.path.join(output_dir, "dirs.txt")) as f:
+        # mode,uid,gid,'path'
+        dirs = {line.split(",", 3)[3] for line in f.read().splitlines()}
+    with open(os.path.join(output_dir, "symlinks.txt")) as f:
+        # mode,uid,gid,'path','target'
+        symlinks = {line.split(",", 3)[3] for line in f.read().splitlines()}
+    regulars = _regular_paths(os.path.join(output_dir, "regulars.txt"))
+
+    install_prefix = "/home/autoware/autoware.proj/install"
+    assert dirs == {
+        "'/boot'",
+        "'/home'",
+        "'/home/autoware'",
+        "'/home/autoware/autoware.proj'",
+        f"'{install_prefix}'",
+    }
+    assert symlinks == {
+        f"'{install_prefix}/file_001','{os.path.abspath(build_file1)}'",
+        f"'{install_prefix}/file_002','../build/file_002'",
+        f"'{install_prefix}/file_003','../src/file_001'",
+    }
+    # build/src are ignored, and only the latest kernel is kept
+    assert regulars.keys() == {
+        "'/boot/vmlinuz-5.15.0-64-generic'",
+        "'/boot/initrd.img-5.15.0-64-generic'",
+        f"'{install_prefix}/file_000'",
+    }
 
-    assert latest == unordered(
+    total_regular_size = _read_file(os.path.join(output_dir, "total_regular_size.txt"))
+    assert total_regular_size == str(len("install_file0" * 100))
+    if compress:
+        # only the non-empty regular file is large enough to be compressed
+        assert len(os.listdir(compressed_dir)) == 1
+
+
+IGNORE_PROFILES = {
+    "default": [
+        "__pycache__/",
+        ".git/",
+        "*.pyc",
+        "/home/autoware/*/build",
+        "/home/autoware/*/src",
+    ],
+    # negation rules disable pruning of the ignored directories
+    "negation": [
+        "*.log",
+        "!keep.log",
+        "/var/cache",
+    ],
+}
+
+
+IGNORE_CASES = [
+    ("default", "home/autoware/autoware.proj/build/file_001", True),
+    ("default", "home/autoware/autoware.proj/build/sub/dir/file_002", True),
+    ("default", "home/autoware/autoware.proj/src/file_001", True),
+    ("default", "home/autoware/autoware.proj/install/file_001", False),
+    ("default", "home/autoware/other.proj/build/file_001", True),
+    ("default", "home/autoware/build/file_001", False),
+    ("default", "usr/lib/python3/dist-packages/mod.py", False),
+    ("default", "usr/lib/python3/dist-packages/mod.pyc", True),
+    ("default", "usr/lib/python3/dist-packages/__pycache__/mod.pyc", True),
+    ("default", "opt/repo/.git/HEAD", True),
+    ("default", "opt/repo/README.md", False),
+    ("negation", "var/log/syslog.log", True),
+    ("negation", "var/log/keep.log", False),
+    ("negation", "var/cache/data.bin", True),
+    ("negation", "var/cache/keep.log", False),
+]
+
+
+@pytest.fixture(scope="module")
+def ignore_profile_regulars(tmp_path_factory):
+    """Return the regular paths generated with each ignore profile.
+
+    All the cases of a profile share one rootfs, so gen_metadata runs only once
+    per profile.
+    """
+    generated = {}
+
+    def _regulars(ignore_profile):
+        if ignore_profile in generated:
+            return generated[ignore_profile]
+
+        root = str(tmp_path_factory.mktemp(f"ignore_{ignore_profile}"))
+        target_dir = os.path.join(root, "rootfs")
+        ignore_file = os.path.join(root, "ignore.txt")
+        _write_file(ignore_file, "\n".join(IGNORE_PROFILES[ignore_profile]))
+        # kernels are specified by extlinux.conf, so none of them are skipped
+        extlinux_dir = os.path.join(target_dir, "boot", "extlinux")
+        os.makedirs(extlinux_dir)
+        _write_file(os.path.join(extlinux_dir, "extlinux.conf"))
+        for profile, case_path, _ in IGNORE_CASES:
+            if profile == ignore_profile:
+                case_file = os.path.join(target_dir, case_path)
+                os.makedirs(os.path.dirname(case_file), exist_ok=True)
+                _write_file(case_file)
+
+        output_dir = _run_gen_metadata(root, target_dir, ignore_file=ignore_file)
+        generated[ignore_profile] = _regular_paths(
+            os.path.join(output_dir, "regulars.txt")
+        )
+        return generated[ignore_profile]
+
+    return _regulars
+
+
+@pytest.mark.parametrize("ignore_profile, case_path, ignored", IGNORE_CASES)
+def test_metadata_ignore_cases(
+    ignore_profile_regulars, ignore_profile, case_path, ignored
+):
+    regulars = ignore_profile_regulars(ignore_profile)
+    assert (f"'/{case_path}'" not in regulars) == ignored
+
+
+def test_gen_metadata_parallel_equivalence(tmp_path):
+    root = str(tmp_path)
+    target_dir = os.path.join(root, "rootfs")
+    os.makedirs(os.path.join(target_dir, "boot", "extlinux"))
+    _write_file(os.path.join(target_dir, "boot", "extlinux", "extlinux.conf"))
+    for i in range(8):
+        d = os.path.join(target_dir, "usr", f"dir_{i}")
+        os.makedirs(d)
+        for j in range(8):
+            _write_file(os.path.join(d, f"file_{j}"), f"{i}-{j} " * (j * 1024))
+        os.symlink(f"file_{i}", os.path.join(d, "link"))
+    # hard links are hashed only once, whichever worker gets them first
+    os.link(
+        os.path.join(target_dir, "usr", "dir_0", "file_7"),
+        os.path.join(target_dir, "usr", "dir_7", "hardlink"),
+    )
+
+    outputs = {}
+    # -1 runs the zstd threads on all the CPUs
+    for workers, compress_workers, zstd_threads in ((1, 1, 1), (4, 2, -1)):
+        compressed_dir = os.path.join(root, f"data_{workers}.zst")
+        output_dir = _run_gen_metadata(
+            root,
+            target_dir,
+            output=f"output_{workers}",
+            compressed_dir=compressed_dir,
+            filesize_threshold=1024,
+            workers=workers,
+            compress_workers=compress_workers,
+            zstd_threads=zstd_threads,
+        )
+        outputs[workers] = {
+            name: _read_file(os.path.join(output_dir, name))
+            for name in os.listdir(output_dir)
+        }
+        outputs[workers]["compressed"] = sorted(os.listdir(compressed_dir))
+
+    assert outputs[1] == outputs[4]
+
+
+@pytest.mark.parametrize("workers, compress_workers", [(0, 1), (1, 0), (-1, 4)])
+def test_gen_metadata_invalid_workers(tmp_path, workers, compress_workers):
+    target_dir = os.path.join(tmp_path, "rootfs")
+    os.mkdir(target_dir)
+
+    with pytest.raises(ValueError):
+        _run_gen_metadata(
+            str(tmp_path),
+            target_dir,
+            compressed_dir=os.path.join(tmp_path, "data.zst"),
+            workers=workers,
+            compress_workers=compress_workers,
+            zstd_threads=1,
+        )
+
+
+@pytest.mark.parametrize(
+    "rules",
+    [
+        IGNORE_PROFILES["default"],
+        IGNORE_PROFILES["negation"],
+        ["home/autoware/autoware.proj/build", "home/autoware/autoware.proj/src"],
+        ["*.py/", "lib", "a/**/b", "[a-c]*.txt", "!b.txt", "/opt/*/"],
+    ],
+)
+def test_ignore_matcher(tmp_path, rules):
+    root = str(tmp_path)
+    for d in [
+        "home/autoware/autoware.proj/build/sub",
+        "home/autoware/autoware.proj/src",
+        "home/autoware/build/__pycache__",
+        "usr/lib/python3/mod.py",
+        "opt/repo/.git",
+        "var/log",
+        "var/cache/a/x/b",
+    ]:
+        os.makedirs(os.path.join(root, d))
+    _touch_many(
+        root,
         [
-            str(tmp_path / "vmlinuz-5.15.0-27-generic"),
-            str(tmp_path / "vmlinuz-5.4.0-102-generic"),
-            str(tmp_path / "vmlinuz-4.12.0-27-generic"),
-            str(tmp_path / "initrd.img-5.15.0-65-generic"),
-            str(tmp_path / "initrd.img-5.4.0-102-generic"),
-            str(tmp_path / "initrd.img-4.12.0-27-generic"),
-        ]
+            "home/autoware/autoware.proj/build/sub/file.pyc",
+            "home/autoware/autoware.proj/src/a.txt",
+            "home/autoware/build/__pycache__/mod.pyc",
+            "usr/lib/python3/mod.py/b.txt",
+            "usr/lib/python3/lib",
+            "opt/repo/.git/HEAD",
+            "var/log/keep.log",
+            "var/log/syslog.log",
+            "var/cache/a/x/b/c.txt",
+        ],
     )
 
+    parser = igittigitt.IgnoreParser()
+    for rule in rules:
+        parser.add_rule(rule, base_path=root)
+    matcher = metadata_gen._IgnoreMatcher(parser, root)
 
-def test_list_non_latest_kernels_empty(tmp_path):
-    import metadata_gen
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            assert matcher.match(path, os.path.isfile(path)) == parser.match(path)
 
-    (tmp_path / "extlinux").mkdir()
-    (tmp_path / "extlinux" / "extlinux.conf").write_text("")
 
-    non_latests = metadata_gen._list_non_latest_kernels(tmp_path)
-    assert non_latests == []
+def test_gen_metadata_hash_cache(tmp_path):
+    root = str(tmp_path)
+    target_dir = os.path.join(root, "rootfs")
+    hash_cache = os.path.join(root, "hash_cache.json")
+    os.makedirs(os.path.join(target_dir, "boot", "extlinux"))
+    _write_file(os.path.join(target_dir, "boot", "extlinux", "extlinux.conf"))
+    unchanged = os.path.join(target_dir, "unchanged")
+    changed = os.path.join(target_dir, "changed")
+    _write_file(unchanged, "unchanged")
+    _write_file(changed, "before")
+
+    def _gen_metadata():
+        output_dir = _run_gen_metadata(root, target_dir, hash_cache=hash_cache)
+        return _regular_paths(os.path.join(output_dir, "regulars.txt"))
+
+    first = _gen_metadata()
+    assert first["'/changed'"] == hashlib.sha256(b"before").hexdigest()
+
+    # the hash of an unchanged file is taken from the cache without reading it
+    with open(hash_cache) as f:
+        cache = json.load(f)
+    unchanged_key = metadata_gen._hash_cache_key(os.lstat(unchanged))
+    assert cache[unchanged_key] == first["'/unchanged'"]
+    cached = hashlib.sha256(b"cached").hexdigest()
+    cache[unchanged_key] = cached
+    with open(hash_cache, "w") as f:
+        json.dump(cache, f)
+    _write_file(changed, "after")
+
+    second = _gen_metadata()
+    assert second["'/unchanged'"] == cached
+    assert second["'/changed'"] == hashlib.sha256(b"after").hexdigest()
+
+    # a broken cache, i.e., truncated by a killed run, is rebuilt
+    _write_file(hash_cache, '{"truncated')
+    third = _gen_metadata()
+    assert third["'/unchanged'"] == hashlib.sha256(b"unchanged").hexdigest()
+    with open(hash_cache) as f:
+        assert json.load(f)[unchanged_key] == third["'/unchanged'"]
+
+
+@pytest.mark.parametrize("content", [b"", b'{"truncated', b"\xff\xfe", b"[]"])
+def test_load_hash_cache_broken(tmp_path, content):
+    hash_cache = tmp_path / "hash_cache.json"
+    hash_cache.write_bytes(content)
+
+    # a broken cache is treated as empty instead of failing the generation
+    assert metadata_gen._load_hash_cache(str(hash_cache)) == {}
+
+
+def test_load_hash_cache_broken_entries(tmp_path):
+    hash_cache = tmp_path / "hash_cache.json"
+    valid = hashlib.sha256(b"valid").hexdigest()
+    cache = {
+        "1:1:5:0:0": valid,
+        "1:2:5:0:0": "cached",
+        "1:3:5:0:0": valid.upper(),
+        "1:4:5:0:0": valid + "\n",
+        "1:5:5:0:0": None,
+        "1:6:5:0:0": ["not", "a", "hash"],
+    }
+    hash_cache.write_text(json.dumps(cache))
+
+    # only sha256 hex digests are used, other entries are skipped
+    assert metadata_gen._load_hash_cache(str(hash_cache)) == {"1:1:5:0:0": valid}
+
+
+@pytest.fixture(scope="module")
+def zstd_cctx():
+    """Compressor shared by the zstd tests, set up as in gen_metadata."""
+    return zstandard.ZstdCompressor(
+        compression_params=zstandard.ZstdCompressionParameters(
+            compression_level=metadata_gen.ZSTD_COMPRESSION_LEVEL,
+            window_log=metadata_gen.ZSTD_WINDOW_LOG,
+            threads=metadata_gen.ZSTD_MULTITHREADS,
+        )
+    )
+
+
+@pytest.mark.parametrize(
+    "pattern, size, compressed",
+    [
+        (b"x", 1024, True),  # fits in the probe
+        (b"Stream writer test ", 20000 * 19, True),  # larger than the probe
+        (None, 1024, False),
+        (None, 1024**2, False),
+    ],
+)
+def test_zstd_compress_file(tmp_path, zstd_cctx, pattern, size, compressed):
+    # NOTE: build the data here rather than at collection, random (None) data
+    #       is incompressible
+    data = os.urandom(size) if pattern is None else pattern * (size // len(pattern))
+    src = tmp_path / "src"
+    dst = tmp_path / "dst.zst"
+    src.write_bytes(data)
+
+    assert (
+        metadata_gen.zstd_compress_file(
+            zstd_cctx, str(src), str(dst), cmpr_ratio=1.25, filesize_threshold=1
+        )
+        == compressed
+    )
+    if compressed:
+        assert zstandard.ZstdDecompressor().decompress(dst.read_bytes()) == data
+    else:
+        assert not dst.exists()
+
+
+@pytest.mark.parametrize(
+    "size",
+    [
+        1024,  # written from the probe
+        metadata_gen.ZSTD_PROBE_SIZE * 4,  # streamed
+    ],
+)
+def test_zstd_compress_file_cleanup(tmp_path, zstd_cctx, monkeypatch, size):
+    src = tmp_path / "src"
+    src.write_bytes(b"x" * size)
+
+    def _replace(src, dst):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(os, "replace", _replace)
+    with pytest.raises(KeyboardInterrupt):
+        metadata_gen.zstd_compress_file(
+            zstd_cctx,
+            str(src),
+            str(tmp_path / "dst.zst"),
+            cmpr_ratio=1.25,
+            filesize_threshold=1,
+        )
+    # no temporary file is left behind
+    assert os.listdir(tmp_path) == ["src"]
+
+
+@pytest.mark.parametrize("extra", [-1, 0, 1, 4096])
+def test_file_sha256(tmp_path, extra):
+    # around the read buffer size, where larger files are hashed through mmap
+    data = os.urandom(metadata_gen.CHUNK_SIZE + extra)
+    src = tmp_path / "src"
+    src.write_bytes(data)
+
+    assert metadata_gen._file_sha256(str(src)) == hashlib.sha256(data).hexdigest()
@@ -0,0 +1,137 @@
+# Copyright 2022 TIER IV, INC. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import json
+import base64
+import hashlib
+import pytest
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+import metadata_sign
+
+
+@pytest.fixture(scope="module")
+def private_key():
+    # a fixed scalar keeps the test key reproducible
+    return ec.derive_private_key(int.from_bytes(b"\x01" * 32, "big"), ec.SECP256R1())
+
+
+@pytest.fixture(params=["PEM", "DER"])
+def sign_key(request, tmp_path, private_key):
+    """Return the private key and the path to its PEM or DER file."""
+    key_file = tmp_path / "sign.key"
+    key_file.write_bytes(
+        private_key.private_bytes(
+            getattr(serialization.Encoding, request.param),
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+    )
+    return private_key, str(key_file)
+
+
+@pytest.mark.parametrize("extra", [None, -1, 0, 1])
+def test_file_sha256(tmp_path, extra):
+    # around the size above which files are hashed through mmap
+    size = 0 if extra is None else metadata_sign.MMAP_THRESHOLD + extra
+    data = os.urandom(size)
+    src = tmp_path / "src"
+    src.write_bytes(data)
+
+    assert metadata_sign._file_sha256(str(src)) == hashlib.sha256(data).hexdigest()
+
+
+def test_gen_payload(tmp_path):
+    names = ["dirs.txt", "symlinks.txt", "regulars.txt", "persistents.txt", "cert.pem"]
+    paths = []
+    for name in names:
+        path = tmp_path / name
+        path.write_text(f"{name} content")
+        paths.append(str(path))
+    (tmp_path / "total_regular_size.txt").write_text("1234")
+
+    payload = metadata_sign.gen_payload(
+        *paths[:4],
+        "rootfs",
+        paths[4],
+        str(tmp_path / "total_regular_size.txt"),
+        "data",
+    )
+
+    def _sha256(name):
+        return hashlib.sha256(f"{name} content".encode()).hexdigest()
+
+    # the hashes are computed in parallel, but keep the order of the fields
+    assert json.loads(base64.urlsafe_b64decode(payload)) == [
+        {"version": 1},
+        {"directory": "dirs.txt", "hash": _sha256("dirs.txt")},
+        {"symboliclink": "symlinks.txt", "hash": _sha256("symlinks.txt")},
+        {"regular": "regulars.txt", "hash": _sha256("regulars.txt")},
+        {"persistent": "persistents.txt", "hash": _sha256("persistents.txt")},
+        {"rootfs_directory": "rootfs"},
+        {"certificate": "cert.pem", "hash": _sha256("cert.pem")},
+        {"total_regular_size": "1234"},
+        {"compressed_rootfs_directory": "data"},
+    ]
+
+
+def test_gen_header():
+    header = metadata_sign.gen_header()
+    assert json.loads(base64.urlsafe_b64decode(header)) == {"alg": "ES256"}
+    assert metadata_sign.gen_header() == header
+
+
+def test_sign(sign_key):
+    priv, key_file = sign_key
+    data = f"{metadata_sign.gen_header()}.payload"
+
+    signature = base64.urlsafe_b64decode(metadata_sign.sign(key_file, data))
+
+    pub = priv.public_key()
+    pub.verify(signature, data.encode(), ec.ECDSA(hashes.SHA256()))
+    with pytest.raises(InvalidSignature):
+        pub.verify(signature, b"tampered", ec.ECDSA(hashes.SHA256()))
+
+
+def test_sign_metadata(tmp_path, sign_key):
+    priv, key_file = sign_key
+    names = ["dirs.txt", "symlinks.txt", "regulars.txt", "persistents.txt", "cert.pem"]
+    for name in names:
+        (tmp_path / name).write_text(f"{name} content")
+    output_file = tmp_path / "metadata.jwt"
+
+    metadata_sign.sign_metadata(
+        directory_file=str(tmp_path / "dirs.txt"),
+        symlink_file=str(tmp_path / "symlinks.txt"),
+        regular_file=str(tmp_path / "regulars.txt"),
+        persistent_file=str(tmp_path / "persistents.txt"),
+        rootfs_directory="rootfs",
+        sign_key_file=key_file,
+        cert_file=str(tmp_path / "cert.pem"),
+        total_regular_size_file=str(tmp_path / "total_regular_size.txt"),
+        compressed_rootfs_directory=None,
+        output_file=str(output_file),
+    )
+
+    header, payload, signature = output_file.read_text().split(".")
+    assert header == metadata_sign.gen_header()
+    assert len(json.loads(base64.urlsafe_b64decode(payload))) == 7
+    priv.public_key().verify(
+        base64.urlsafe_b64decode(signature),
+        f"{header}.{payload}".encode(),
+        ec.ECDSA(hashes.SHA256()),
+    )